@@ -0,0 +1,128 @@
+import threading
+
+from six.moves import http_client
+from boto3 import Session
+from botocore import httpsession
+from botocore.client import Config
+
+
+CLIENT_CONFIG = Config(
+    max_pool_connections=32,
+    retries={'max_attempts': 10, 'mode': 'adaptive'}
+)
+
+SERVICE_CONFIG = {
+    's3': Config(signature_version='s3v4')
+}
+
+HTTP_BLOCKSIZE = 1024 * 1024
+
+_http_blocksize_patched = False
+
+_sessions = {}
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _set_default_blocksize(function, blocksize):
+    function = getattr(function, '__func__', function)
+    code = getattr(function, '__code__', None)
+    if code is None:
+        return
+
+    names = code.co_varnames[:code.co_argcount]
+    defaults = function.__defaults__
+    if 'blocksize' in names and defaults:
+        index = names.index('blocksize') - (len(names) - len(defaults))
+        if index >= 0:
+            defaults = list(defaults)
+            defaults[index] = blocksize
+            function.__defaults__ = tuple(defaults)
+
+    kwdefaults = getattr(function, '__kwdefaults__', None)
+    if kwdefaults and 'blocksize' in kwdefaults:
+        kwdefaults['blocksize'] = blocksize
+
+
+def enlarge_http_blocksize(blocksize=HTTP_BLOCKSIZE):
+    """
+    Raises the write buffer of HTTP(S) connections used by botocore. With
+    the default 8-16 KiB buffer every upload part is sent in many small
+    writes and upload threads keep contending for the GIL.
+
+    Both plain and TLS connection classes of http.client and urllib3 are
+    patched, urllib3 2.x HTTPSConnection declares its own default. Recent
+    botocore passes its own blocksize to urllib3 2.x pools, that value is
+    raised too. Clients created before the call keep their pools, so it
+    has to be called before the client is created. Python 2 has no such
+    buffer and is left untouched.
+    """
+    global _http_blocksize_patched
+    if _http_blocksize_patched:
+        return
+
+    connection_classes = [http_client.HTTPConnection,
+                          getattr(http_client, 'HTTPSConnection', None)]
+    try:
+        from urllib3 import connection
+    except ImportError:
+        pass
+    else:
+        connection_classes += [connection.HTTPConnection,
+                               connection.HTTPSConnection]
+
+    for connection_class in connection_classes:
+        if connection_class is not None:
+            _set_default_blocksize(connection_class.__init__, blocksize)
+
+    if getattr(httpsession, 'BUFFER_SIZE', None):
+        httpsession.BUFFER_SIZE = max(httpsession.BUFFER_SIZE, blocksize)
+
+    _http_blocksize_patched = True
+
+
+def _get_session(profile):
+    """
+    Returns boto3 session of given profile. Session is created once, so
+    credentials, service data and SSL context are loaded only once.
+    Must be called with _clients_lock held, sessions are not thread safe.
+    :param profile: AWS credentials profile name.
+    :return: boto3 session.
+    """
+    if profile not in _sessions:
+        _sessions[profile] = Session(profile_name=profile)
+    return _sessions[profile]
+
+
+def make_config(service):
+    """
+    Returns botocore config of clients of given service.
+    :param service: AWS service name, e.g. s3 or cloudformation.
+    :return: botocore config.
+    """
+    config = CLIENT_CONFIG
+    if service in SERVICE_CONFIG:
+        config = config.merge(SERVICE_CONFIG[service])
+    return config
+
+
+def get_client(service, profile=None, region=None):
+    """
+    Returns boto3 client shared by all callers with the same service,
+    profile and region. Clients are thread safe, so one client per
+    configuration is reused instead of loading service data and opening
+    a new connection pool every time.
+    :param service: AWS service name, e.g. s3 or cloudformation.
+    :param profile: AWS credentials profile name.
+    :param region: AWS region name.
+    :return: boto3 client.
+    """
+    key = (service, profile, region)
+    with _clients_lock:
+        if key not in _clients:
+            if service == 's3':
+                enlarge_http_blocksize()
+            _clients[key] = _get_session(profile).client(
+                service, region_name=region, config=make_config(service))
+
+        return _clients[key]
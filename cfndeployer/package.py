@@ -2,42 +2,239 @@ import json
 import os
 import sys
 import errno
+import mmap
+import contextlib
 import uuid
 import hashlib
-import yaml
 import threading
+import multiprocessing
 
+from concurrent.futures import Future, ThreadPoolExecutor
+from six import string_types
 from boto3 import Session
-from boto3.s3.transfer import TransferManager, BaseSubscriber
-from botocore.client import Config
+from boto3.s3.transfer import TransferManager, TransferConfig, \
+    BaseSubscriber
+from s3transfer.utils import ChunksizeAdjuster
 from botocore.exceptions import ClientError
 
+from .client import get_client, enlarge_http_blocksize
 from .exceptions import TemplateNotSpecified, InvalidTemplatePathError, \
     NoSuchBucketException
-from .template import Template
+from .template import Template, yaml_dump
+
+
+CHECKSUM_BLOCK_SIZE = 1 << 20
+SMALL_FILE_SIZE = 8 * 1024 * 1024
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+def new_checksum():
+    """
+    Returns new hash object used to name S3 objects by their content.
+    Falls back to MD5 on Python versions without BLAKE2b.
+    """
+    if hasattr(hashlib, 'blake2b'):
+        return hashlib.blake2b(digest_size=16)
+    return hashlib.md5()
+
+
+_worker_client = None
+
+
+def _init_upload_worker(credentials, region, endpoint_url, config):
+    """
+    Creates S3 client of multipart upload worker process. Clients can't be
+    shared between processes, so each worker has its own one with the
+    credentials, endpoint and config of the uploader's client.
+    """
+    global _worker_client
+    enlarge_http_blocksize()
+    session = Session(*credentials) if credentials else Session()
+    _worker_client = session.client(
+        's3', region_name=region, endpoint_url=endpoint_url, config=config)
+
+
+def _upload_part(part):
+    """
+    Uploads single part of multipart upload. Worker reads its byte range
+    from the file itself, so only offsets are passed between processes.
+    :return: Part number, ETag and size of the uploaded part
+    """
+    file_name, bucket, key, upload_id, part_number, offset, length = part
+    with open(file_name, 'rb') as file_handle:
+        file_handle.seek(offset)
+        body = file_handle.read(length)
+
+    response = _worker_client.upload_part(
+        Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number,
+        Body=body)
+    return part_number, response['ETag'], length
 
 
 class ProgressPercentage(BaseSubscriber):
     # This class was copied directly from S3Transfer docs
-    def __init__(self, filename, remote_path):
+    # Progress is printed only when it advances by at least one percent,
+    # since multipart uploads report progress for every few KiB sent.
+    # Output of all uploads is serialized. Progress is updated in place
+    # only while a single upload runs, parallel uploads print one line
+    # each once completed.
+    _output_lock = threading.Lock()
+    _active = 0
+
+    def __init__(self, filename, remote_path, size=None):
         self._filename = filename
         self._remote_path = remote_path
-        self._size = float(os.path.getsize(filename))
+        if size is None:
+            size = os.path.getsize(filename)
+        self._size = float(size)
         self._seen_so_far = 0
+        self._last_printed = None
         self._lock = threading.Lock()
 
+    def on_queued(self, future, **kwargs):
+        with self._output_lock:
+            ProgressPercentage._active += 1
+
     def on_progress(self, future, bytes_transferred, **kwargs):
 
         # To simplify we'll assume this is hooked up
         # to a single filename.
         with self._lock:
             self._seen_so_far += bytes_transferred
-            percentage = (self._seen_so_far / self._size) * 100
-            sys.stdout.write(
-                    "\rUploading to %s  %s / %s  (%.2f%%)" %
-                    (self._remote_path, self._seen_so_far,
-                     self._size, percentage))
-            sys.stdout.flush()
+            percentage = (self._seen_so_far / self._size) * 100 \
+                if self._size else 100.0
+            if self._last_printed is not None and percentage < 100 and \
+                    percentage - self._last_printed < 1:
+                return
+
+            self._last_printed = percentage
+            seen_so_far = self._seen_so_far
+
+        with self._output_lock:
+            if ProgressPercentage._active <= 1:
+                self._write(seen_so_far, percentage)
+
+    def on_done(self, future, failed=False, **kwargs):
+        if future is not None:
+            try:
+                future.result()
+            except Exception:
+                failed = True
+
+        with self._output_lock:
+            ProgressPercentage._active -= 1
+            if not failed:
+                self._write(self._seen_so_far, 100.0)
+                sys.stdout.write("\n")
+                sys.stdout.flush()
+
+    def _write(self, seen_so_far, percentage):
+        sys.stdout.write(
+                "\rUploading to %s  %s / %s  (%.2f%%)" %
+                (self._remote_path, seen_so_far, self._size, percentage))
+        sys.stdout.flush()
+
+
+class DedupCache(object):
+    """
+    Local index of files already uploaded to S3. Files are identified by
+    path, size and modification time, so unchanged files are neither hashed
+    nor looked up in S3 again. Cache without path is disabled.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._entries = {}
+        self._changed = False
+        self._lock = threading.Lock()
+
+        if path:
+            try:
+                with open(path, 'r') as fp:
+                    self._entries = self._valid_entries(json.load(fp))
+            except (EnvironmentError, ValueError):
+                pass
+
+    @staticmethod
+    def _valid_entries(entries):
+        """
+        Drops malformed entries of cache file, e.g. written by other version.
+        :param entries: Content of cache file
+        :return: Dict of valid entries
+        """
+        if not isinstance(entries, dict):
+            return {}
+        return {key: entry for key, entry in entries.items()
+                if isinstance(entry, dict) and
+                isinstance(entry.get('path'), string_types) and
+                isinstance(entry.get('url'), string_types)}
+
+    @staticmethod
+    def make_key(file_name, stat, *scope):
+        """
+        Makes cache key of the file in its current state
+        :param file_name: Path to the file
+        :param stat: Result of os.stat of the file
+        :param scope: Values the cached entry depends on, e.g. bucket name
+        :return: Cache key
+        """
+        mtime = getattr(stat, 'st_mtime_ns', stat.st_mtime)
+        return json.dumps([os.path.abspath(file_name), mtime, stat.st_size] +
+                          list(scope))
+
+    def get(self, key):
+        if not self.path:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry['url'] if entry else None
+
+    def set(self, key, file_name, url):
+        if not self.path:
+            return
+
+        with self._lock:
+            self._entries[key] = {
+                'path': os.path.abspath(file_name),
+                'url': url
+            }
+            self._changed = True
+
+    def save(self):
+        """
+        Writes cache to disk. Entries of files that no longer exist, such as
+        temporary zip files, are dropped. Cache is only an optimisation, so
+        failure to write it is ignored. File is written to a temporary file
+        first, so concurrent runs never leave a truncated cache behind.
+        """
+        if not self.path or not self._changed:
+            return
+
+        with self._lock:
+            self._entries = {key: entry for key, entry in self._entries.items()
+                             if os.path.exists(entry['path'])}
+            data = json.dumps(self._entries)
+            self._changed = False
+
+        temporary_path = '{}.{}.tmp'.format(self.path, uuid.uuid4().hex)
+        try:
+            if not os.path.exists(os.path.dirname(self.path)):
+                try:
+                    os.makedirs(os.path.dirname(self.path))
+                except OSError as ex:
+                    if ex.errno != errno.EEXIST:
+                        raise
+            with open(temporary_path, 'w') as fp:
+                fp.write(data)
+            _replace(temporary_path, self.path)
+        except EnvironmentError:
+            if os.path.exists(temporary_path):
+                try:
+                    os.remove(temporary_path)
+                except EnvironmentError:
+                    pass
 
 
 class S3Uploader(object):
@@ -48,47 +245,109 @@ class S3Uploader(object):
     customizations/cloudformation/s3uploader.py
     """
 
+    MAX_WORKERS = 16
+
+    CHECKSUM_METADATA = 'contenthash'
+
+    MULTIPART_THRESHOLD = 64 * 1024 * 1024
+    MULTIPART_CHUNKSIZE = 64 * 1024 * 1024
+    MAX_CONCURRENCY = 16
+
+    MULTIPROCESS_THRESHOLD = 256 * 1024 * 1024
+    MULTIPROCESS_WORKERS = 4
+
+    CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache',
+                              'cfndeployer', 'dedup.json')
+
     def __init__(self, s3_client, bucket_name, region, prefix=None,
-                 kms_key_id=None, force_upload=False):
+                 kms_key_id=None, force_upload=False,
+                 multipart_threshold=MULTIPART_THRESHOLD,
+                 multipart_chunksize=MULTIPART_CHUNKSIZE,
+                 max_concurrency=MAX_CONCURRENCY, cache_file=CACHE_FILE,
+                 multiprocess_threshold=None):
         self.bucket_name = bucket_name
         self.prefix = prefix
         self.kms_key_id = kms_key_id or None
         self.force_upload = force_upload
         self.s3 = s3_client
         self.region = region
-        self.transfer_manager = TransferManager(self.s3)
-
-    def upload(self, filename, remote_path):
+        self.multiprocess_threshold = multiprocess_threshold
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=max_concurrency,
+            use_threads=True)
+        self.transfer_manager = TransferManager(
+            self.s3, config=self.transfer_config)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._local = threading.local()
+        # Forced uploads never read the cache, so it isn't loaded at all
+        self.cache = DedupCache(None if force_upload else cache_file)
+        self._process_pool = None
+        self._process_pool_lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Runs given callable in the uploader's thread pool. Calls made from
+        within the pool (e.g. nested templates) are run immediately to
+        avoid workers waiting on each other.
+        :return: Future with the callable's result
+        """
+        if getattr(self._local, 'in_worker', False):
+            future = Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as ex:
+                future.set_exception(ex)
+            return future
+
+        return self._get_executor().submit(
+            self._run_in_worker, fn, args, kwargs)
+
+    def _run_in_worker(self, fn, args, kwargs):
+        self._local.in_worker = True
+        return fn(*args, **kwargs)
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.MAX_WORKERS)
+            return self._executor
+
+    def upload(self, filename, remote_path, checksum=None, size=None):
         """
         Uploads given file to S3
         :param file_name: Path to the file that will be uploaded
         :param remote_path:  be uploaded
+        :param checksum: Checksum of the file, if already known
+        :param size: Size of the file, if already known
         :return: VersionId of the latest upload
         """
 
-        if self.prefix and len(self.prefix) > 0:
-            remote_path = '{}/{}'.format(self.prefix, remote_path)
+        remote_path = self.make_remote_path(remote_path)
 
         # Check if a file with same data exists
-        if not self.force_upload and self.file_exists(remote_path):
+        if not self.force_upload and self.is_uploaded(
+                filename, remote_path, checksum, size):
             return self.make_url(remote_path)
 
         try:
-
-            # Default to regular server-side encryption unless customer has
-            # specified their own KMS keys
-            additional_args = {
-                'ServerSideEncryption': 'AES256'
-            }
-
-            if self.kms_key_id:
-                additional_args['ServerSideEncryption'] = 'aws:kms'
-                additional_args['SSEKMSKeyId'] = self.kms_key_id
-
-            progress_procentage = ProgressPercentage(filename, remote_path)
-            self.transfer_manager.upload(
-                filename, self.bucket_name, remote_path, additional_args,
-                [progress_procentage]).result()
+            if size is None:
+                size = os.path.getsize(filename)
+
+            progress_procentage = ProgressPercentage(
+                filename, remote_path, size)
+            if self.use_multiprocess(size):
+                self.multiprocess_upload(
+                    filename, remote_path, self.make_extra_args(checksum),
+                    size, progress_procentage)
+            else:
+                self.transfer_manager.upload(
+                    filename, self.bucket_name, remote_path,
+                    self.make_extra_args(checksum),
+                    [progress_procentage]).result()
 
             return self.make_url(remote_path)
 
@@ -101,19 +360,186 @@ class S3Uploader(object):
 
     def upload_with_dedup(self, file_name, extension=None):
         """
-        Makes and returns name of the S3 object based on the file's MD5 sum
+        Makes and returns name of the S3 object based on the file's checksum
 
         :param file_name: file to upload
         :param extension: String of file extension to append to the object
         :return: S3 URL of the uploaded object
         """
 
-        filemd5 = self.file_checksum(file_name)
-        remote_path = filemd5
-        if extension:
-            remote_path = '{}.{}'.format(remote_path,extension)
+        # File is stat'ed once, the result is reused for the cache key,
+        # size comparison and upload progress
+        stat = os.stat(file_name)
+
+        cache_key = None
+        if not self.force_upload:
+            cache_key = self.cache.make_key(
+                file_name, stat, self.bucket_name, self.prefix, extension)
+            url = self.cache.get(cache_key)
+            if url:
+                return url
+
+        # Object is named by its checksum, so file is hashed first, reading
+        # it again for upload is cheaper than copying it within S3
+        checksum = self.file_checksum(file_name, stat.st_size)
+        remote_path = self.make_dedup_name(checksum, extension)
+        url = self.upload(file_name, remote_path, checksum, stat.st_size)
+
+        if cache_key:
+            self.cache.set(cache_key, file_name, url)
+        return url
+
+    def close(self):
+        """
+        Shuts down worker threads and processes. Uploader can still be used
+        afterwards, they are started again when needed.
+        """
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+        with self._process_pool_lock:
+            pool, self._process_pool = self._process_pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _get_process_pool(self):
+        """
+        Returns pool of upload worker processes shared by all uploads of
+        this uploader. Workers are spawned rather than forked, forking
+        process which runs upload threads may deadlock. Spawned workers
+        import the caller's __main__ module again, so scripts using
+        multiprocess uploads need an if __name__ == '__main__' guard.
+        """
+        with self._process_pool_lock:
+            if self._process_pool is None:
+                context = multiprocessing
+                if hasattr(multiprocessing, 'get_context'):
+                    context = multiprocessing.get_context('spawn')
+                self._process_pool = context.Pool(
+                    self.MULTIPROCESS_WORKERS, _init_upload_worker,
+                    (self._get_credentials(), self.s3.meta.region_name,
+                     self.s3.meta.endpoint_url, self.s3.meta.config))
+            return self._process_pool
+
+    def _get_credentials(self):
+        """
+        Returns current credentials of the S3 client, so worker processes
+        sign parts the same way the client signs the rest of the upload.
+        :return: Access key, secret key and token. None if client is unsigned
+        """
+        credentials = getattr(self.s3._request_signer, '_credentials', None)
+        if credentials is None:
+            return None
+        credentials = credentials.get_frozen_credentials()
+        return (credentials.access_key, credentials.secret_key,
+                credentials.token)
+
+    def make_parts(self, size):
+        """
+        Splits file into parts of multipart upload. Part size is adjusted
+        to S3 limits on part size and number of parts.
+
+        :param size: Size of the file
+        :return: List of part number, offset and length of each part
+        """
+        part_size = ChunksizeAdjuster().adjust_chunksize(
+            self.transfer_config.multipart_chunksize, size)
+        return [(number + 1, offset, min(part_size, size - offset))
+                for number, offset in enumerate(range(0, size, part_size))]
+
+    def use_multiprocess(self, size):
+        """
+        Multiprocess uploads are opt-in, they are used only for files larger
+        than multiprocess_threshold, e.g. MULTIPROCESS_THRESHOLD.
+        """
+        return self.multiprocess_threshold is not None and \
+            size > self.multiprocess_threshold
+
+    def multiprocess_upload(self, filename, remote_path, extra_args, size,
+                            progress=None):
+        """
+        Uploads large file with multipart upload whose parts are sent by
+        the uploader's pool of worker processes, so TLS encryption of parts
+        isn't limited by the GIL. Multipart upload is aborted on failure.
+
+        :param filename: Path to the file that will be uploaded
+        :param remote_path: S3 key of the uploaded object
+        :param extra_args: Extra arguments of the multipart upload
+        :param size: Size of the file
+        :param progress: ProgressPercentage notified about uploaded parts
+        """
+        pool = self._get_process_pool()
+        upload_id = self.s3.create_multipart_upload(
+            Bucket=self.bucket_name, Key=remote_path,
+            **extra_args)['UploadId']
+
+        parts = [(filename, self.bucket_name, remote_path, upload_id,
+                  part_number, offset, length)
+                 for part_number, offset, length in self.make_parts(size)]
+
+        if progress:
+            progress.on_queued(None)
+        failed = True
+        try:
+            uploaded = []
+            for part_number, etag, length in pool.imap_unordered(
+                    _upload_part, parts):
+                uploaded.append({'PartNumber': part_number, 'ETag': etag})
+                if progress:
+                    progress.on_progress(None, length)
+
+            uploaded.sort(key=lambda part: part['PartNumber'])
+            self.s3.complete_multipart_upload(
+                Bucket=self.bucket_name, Key=remote_path, UploadId=upload_id,
+                MultipartUpload={'Parts': uploaded})
+            failed = False
+        except BaseException:
+            self.s3.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=remote_path, UploadId=upload_id)
+            raise
+        finally:
+            if progress:
+                progress.on_done(None, failed=failed)
+
+    def make_extra_args(self, checksum=None):
+        """
+        Default to regular server-side encryption unless customer has
+        specified their own KMS keys
+        :param checksum: Checksum stored in object metadata, if known
+        :return: Extra arguments for S3 upload and copy
+        """
+        extra_args = {
+            'ServerSideEncryption': 'AES256'
+        }
+
+        if self.kms_key_id:
+            extra_args['ServerSideEncryption'] = 'aws:kms'
+            extra_args['SSEKMSKeyId'] = self.kms_key_id
+
+        if checksum:
+            extra_args['Metadata'] = {self.CHECKSUM_METADATA: checksum}
 
-        return self.upload(file_name, remote_path)
+        return extra_args
+
+    def make_remote_path(self, remote_path):
+        if self.prefix and len(self.prefix) > 0:
+            return '{}/{}'.format(self.prefix, remote_path)
+        return remote_path
+
+    @staticmethod
+    def make_dedup_name(checksum, extension=None):
+        if extension:
+            return '{}.{}'.format(checksum, extension)
+        return checksum
 
     def file_exists(self, remote_path):
         """
@@ -129,30 +555,83 @@ class S3Uploader(object):
         except ClientError:
             return False
 
+    def head(self, remote_path):
+        """
+        Fetches metadata of S3 object
+
+        :param remote_path:
+        :return: HEAD response if object exists. None, otherwise
+        """
+
+        try:
+            return self.s3.head_object(Bucket=self.bucket_name,
+                                       Key=remote_path)
+        except ClientError:
+            return None
+
+    def is_uploaded(self, file_name, remote_path, checksum=None, size=None):
+        """
+        Check if S3 object has the same content as the local file, based on
+        its size and checksum stored in object metadata. Objects uploaded
+        without checksum metadata are compared by size only.
+
+        :param file_name: Path to the local file
+        :param remote_path:
+        :param checksum: Checksum of the local file, if already known
+        :param size: Size of the local file, if already known
+        :return: True, if object is up to date. False, otherwise
+        """
+
+        response = self.head(remote_path)
+        if response is None:
+            return False
+
+        if size is None:
+            size = os.path.getsize(file_name)
+        if response['ContentLength'] != size:
+            return False
+
+        remote_checksum = response.get('Metadata', {}).get(
+            self.CHECKSUM_METADATA)
+        return checksum is None or remote_checksum in (None, checksum)
+
     def make_url(self, obj_path):
         return 's3://{}/{}'.format(self.bucket_name, obj_path)
 
     @staticmethod
-    def file_checksum(file_name):
-
-        with open(file_name, 'rb') as file_handle:
-            md5 = hashlib.md5()
-            # Read file in chunks of 4096 bytes
-            block_size = 4096
-
-            # Save current cursor position and reset cursor to start of file
-            curpos = file_handle.tell()
-            file_handle.seek(0)
+    def file_checksum(file_name, size=None):
+        """
+        Computes checksum of the file content. Checksum is used only as
+        a content key for deduplication, so BLAKE2b is used where available.
 
-            buf = file_handle.read(block_size)
-            while len(buf) > 0:
-                md5.update(buf)
-                buf = file_handle.read(block_size)
+        :param file_name: Path to the file
+        :param size: Size of the file, if already known
+        :return: Hex digest of the file content
+        """
 
-            # Restore file cursor's position
-            file_handle.seek(curpos)
+        with open(file_name, 'rb') as file_handle:
+            checksum = new_checksum()
+            if size is None:
+                size = os.fstat(file_handle.fileno()).st_size
+            if size < SMALL_FILE_SIZE:
+                # Templates are usually small, hash them in one go
+                checksum.update(file_handle.read())
+                return checksum.hexdigest()
 
-            return md5.hexdigest()
+            try:
+                mapped = mmap.mmap(file_handle.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                # File can't be mapped, read it in chunks instead
+                buf = file_handle.read(CHECKSUM_BLOCK_SIZE)
+                while len(buf) > 0:
+                    checksum.update(buf)
+                    buf = file_handle.read(CHECKSUM_BLOCK_SIZE)
+            else:
+                with contextlib.closing(mapped):
+                    checksum.update(mapped)
+
+            return checksum.hexdigest()
 
     def to_path_style_s3_url(self, key, version=None):
         """
@@ -185,15 +664,17 @@ class Package:
         if not os.path.isfile(self.template_file):
             raise InvalidTemplatePathError
 
-        client = Session(profile_name=kwargs.get('Profile', None)).client(
-            's3', config=Config(signature_version='s3v4'), verify=True)
+        client = get_client('s3', self.kwargs.get('Profile'),
+                            self.kwargs.get('Region'))
 
         bucket = self.kwargs.get('Bucket', 'cfndeployer-{}'.format(
             str(uuid.uuid4())))
 
         self.s3_uploader = S3Uploader(
             client, bucket, self.kwargs.get('Region', 'eu-west-1'),
-            self.kwargs.get('StackName', 'cfn'), self.kwargs.get('KMSKey'), True)
+            self.kwargs.get('StackName', 'cfn'), self.kwargs.get('KMSKey'),
+            self.kwargs.get('ForceUpload', True),
+            multiprocess_threshold=self.kwargs.get('MultiprocessThreshold'))
 
     def package(self, use_json=False):
         """
@@ -201,7 +682,11 @@ class Package:
         :return:
         """
         output_file = self.kwargs.get('OutputFile', 'template.package')
-        exported_str = self._export(self.template_file, use_json)
+        try:
+            exported_str = self._export(self.template_file, use_json)
+        finally:
+            self.s3_uploader.close()
+        self.s3_uploader.cache.save()
 
         self._write_output(output_file, exported_str)
         return output_file
@@ -210,8 +695,7 @@ class Package:
         template = Template(template_path, os.getcwd(), self.s3_uploader)
         exported_template = template.export()
         return json.dumps(exported_template, indent=2, ensure_ascii=False) \
-            if use_json else yaml.safe_dump(exported_template,
-                                            default_flow_style=False)
+            if use_json else yaml_dump(exported_template)
 
     @staticmethod
     def _write_output(filename, data):
@@ -1,52 +1,60 @@
 import os
 import time
+import uuid
+import random
 
-from boto3 import Session
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ValidationError, ClientError, \
     ParamValidationError, WaiterError
 
+from .client import get_client
 from .exceptions import EmptyStackName, DeployFailed, TemplateNotSpecified, \
     TemplateValidationError, EmptyChangeSet, UpdateStackError, \
     StackDoesntExist, StackAlreadyExist
 
 
-CFN_KWARGS = (
+CFN_KWARGS = frozenset((
         'StackName', 'TemplateBody', 'TemplateURL', 'Parameters',
         'NotificationARNs', 'Capabilities', 'ResourceTypes', 'RoleARN',
         'StackPolicyBody', 'StackPolicyURL', 'Tags', 'ClientRequestToken'
-    )
+    ))
 
 
 class Stack:
     KWARGS = CFN_KWARGS
 
-    CREATE_KWARGS = KWARGS + (
+    CREATE_KWARGS = KWARGS | frozenset((
         'DisableRollback', 'TimeoutInMinutes', 'OnFailure'
-    )
+    ))
 
-    UPDATE_KWARGS = KWARGS + (
+    UPDATE_KWARGS = KWARGS | frozenset((
         'UsePreviousTemplate', 'StackPolicyDuringUpdateBody',
         'StackPolicyDuringUpdateURL',
-    )
+    ))
 
-    DELETE_KWARGS = (
+    DELETE_KWARGS = frozenset((
         'StackName', 'RetainResources', 'RoleARN', 'ClientRequestToken'
-    )
+    ))
 
-    DESCRIBE_STACKS = ('StackName', 'NextToken')
+    DESCRIBE_STACKS = frozenset(('StackName', 'NextToken'))
 
-    CREATE_CHANGE_SET_KWARGS = KWARGS + (
+    CREATE_CHANGE_SET_KWARGS = KWARGS | frozenset((
         'UsePreviousTemplate', 'ChangeSetName', 'ClientToken',
-        'Description', 'ChangeSetType')
+        'Description', 'ChangeSetType'))
 
-    EXECUTE_CHANGE_SET = ('ChangeSetName', 'StackName', 'ClientRequestToken')
+    EXECUTE_CHANGE_SET = frozenset((
+        'ChangeSetName', 'StackName', 'ClientRequestToken'))
 
     CHANGE_SET_PREFIX = 'stack-change-set-'
 
-    WAITER_DELAY = 5
+    WAITER_DELAY = 1
+    WAITER_MAX_DELAY = 15
+    WAITER_TIMEOUT = 60 * 60
+
+    IN_PROGRESS_STATUSES = ('_IN_PROGRESS', '_PENDING')
 
     WAIT_KWARGS = DESCRIBE_STACKS
-    WAIT_CHANGE_SET_KWARGS = DESCRIBE_STACKS + ('ChangeSetName',)
+    WAIT_CHANGE_SET_KWARGS = DESCRIBE_STACKS | frozenset(('ChangeSetName',))
 
     def __init__(self, **kwargs):
         """
@@ -57,60 +65,128 @@ class Stack:
             raise EmptyStackName
 
         self.kwargs = kwargs
-        self._client = Session(profile_name=kwargs.get('Profile', None)).client(
-            'cloudformation')
+        self._prepared_kwargs = {}
+        self._stack_cache = None
+        self._client = get_client('cloudformation', kwargs.get('Profile'),
+                                  kwargs.get('Region'))
 
     def _prepare_kwargs(self, kwargs_list):
         """
-        Prepares kwargs based on allowed ones from kwargs_list.
+        Prepares kwargs based on allowed ones from kwargs_list. Result is
+        computed once and reused until kwargs are changed with _set_kwarg.
         :param kwargs_list: list of allowed kwargs.
         :return: Filtered kwargs.
         """
-        return {key: self.kwargs[key] for key in self.kwargs if key in
-                getattr(self, kwargs_list)}
+        if kwargs_list not in self._prepared_kwargs:
+            allowed = getattr(self, kwargs_list)
+            self._prepared_kwargs[kwargs_list] = {
+                key: self.kwargs[key] for key in
+                allowed.intersection(self.kwargs)}
+        return self._prepared_kwargs[kwargs_list]
+
+    def _set_kwarg(self, key, value):
+        """
+        Sets kwarg value and drops already prepared kwargs.
+        :param key: kwarg name.
+        :param value: kwarg value.
+        :return:
+        """
+        self.kwargs[key] = value
+        self._prepared_kwargs.clear()
+
+    def _load_template(self):
+        """
+        Loads CloudFormation template body if TemplateBody is a path to file.
+        :return:
+        """
+        if 'TemplateBody' in self.kwargs:
+            if os.path.isfile(self.kwargs['TemplateBody']):
+                with open(self.kwargs['TemplateBody'], 'r') as body:
+                    template_body = body.read()
+                self._set_kwarg('TemplateBody', template_body)
+        elif 'TemplateURL' not in self.kwargs:
+            raise TemplateNotSpecified(error=KeyError())
 
     def _validate_template(self):
         """
         Validates CloudFormation template. It can be file, url or template body.
         :return:
         """
+        self._load_template()
+        self._validate_loaded_template()
+
+    def _validate_loaded_template(self):
+        """
+        Validates CloudFormation template already loaded by _load_template.
+        Kwargs are only read, so it can run alongside other calls.
+        :return:
+        """
         try:
             if 'TemplateBody' in self.kwargs:
-                if os.path.isfile(self.kwargs['TemplateBody']):
-                    with open(self.kwargs['TemplateBody'], 'r') as body:
-                        template_body = body.read()
-                    self.kwargs['TemplateBody'] = template_body
                 self._client.validate_template(
                     TemplateBody=self.kwargs['TemplateBody'])
-            elif 'TemplateURL' in self.kwargs:
+            else:
                 self._client.validate_template(
                     TemplateURL=self.kwargs['TemplateURL'])
-            else:
-                raise KeyError
-
-        except KeyError as e:
-            raise TemplateNotSpecified(error=e)
 
         except (ValidationError, ClientError, ParamValidationError) as e:
             raise TemplateValidationError(error=e)
 
-    def _describe_stack(self):
+    def _validate_and_describe(self):
+        """
+        Validates CloudFormation template and describes Stack at the same
+        time, as neither call depends on the other.
+        :return:
         """
-        Describes CloudFormation Stack.
+        # Template body is loaded upfront, so threads don't change kwargs
+        self._load_template()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            validation = executor.submit(self._validate_loaded_template)
+            description = executor.submit(self._describe_stack)
+            validation.result()
+            description.result()
+
+    def _describe_stack(self, refresh=False):
+        """
+        Describes CloudFormation Stack. Result is cached until the Stack is
+        changed by this instance.
+        :param refresh: If True cached result is ignored.
         :return: Returns Stack information if Stack exists. False otherwise.
         """
+        if self._stack_cache is None or refresh:
+            self._stack_cache = self._fetch_stack()
+        return self._stack_cache
+
+    def _fetch_stack(self):
         try:
             stacks = self._client.describe_stacks(
                 **self._prepare_kwargs('DESCRIBE_STACKS'))
             return stacks['Stacks'][0]
 
         except ClientError as ex:
-            if 'Stack with id {0} does not exist'.format(
-                    self.kwargs['StackName']) in str(ex):
+            msg = 'Stack with id {0} does not exist'.format(
+                self.kwargs['StackName'])
+            if self._is_validation_error(ex, msg):
                 return False
             else:
                 raise ex
 
+    @staticmethod
+    def _is_validation_error(ex, message):
+        """
+        Checks if ClientError is a ValidationError with given message.
+        Message is matched case insensitively.
+        :param ex: ClientError.
+        :param message: Part of the error message.
+        :return: True if error matches. False otherwise.
+        """
+        error = ex.response.get('Error', {})
+        return error.get('Code') == 'ValidationError' and \
+            message.lower() in error.get('Message', '').lower()
+
+    def _invalidate_stack_cache(self):
+        self._stack_cache = None
+
     def _stack_exists(self):
         """
         Checks if a CloudFormation stack with given name exists.
@@ -124,22 +200,88 @@ class Stack:
 
     def _create_change_set(self):
         """
-        Creates CloudFormation Change Set.
+        Creates CloudFormation Change Set. CREATE Change Set is tried first,
+        UPDATE one is created if the Stack already exists. Template is
+        validated by CloudFormation while creating Change Set.
         :return:
         """
         if 'ChangeSetName' not in self.kwargs:
-            self.kwargs['ChangeSetName'] = self.CHANGE_SET_PREFIX + \
-                                           str(int(time.time()))
-
-        self.kwargs['ChangeSetType'] = 'UPDATE'
-        if not self._stack_exists():
-            self.kwargs['ChangeSetType'] = 'CREATE'
+            self._set_kwarg('ChangeSetName', self.CHANGE_SET_PREFIX +
+                            uuid.uuid4().hex[:12])
 
+        self._set_kwarg('ChangeSetType', 'CREATE')
         try:
-            self._client.create_change_set(**self._prepare_kwargs(
-                'CREATE_CHANGE_SET_KWARGS'))
-        except Exception as e:
-            raise e
+            try:
+                self._client.create_change_set(**self._prepare_kwargs(
+                    'CREATE_CHANGE_SET_KWARGS'))
+            except ClientError as ex:
+                if not self._is_stack_already_exists(ex):
+                    raise
+                self._set_kwarg('ChangeSetType', 'UPDATE')
+                self._client.create_change_set(**self._prepare_kwargs(
+                    'CREATE_CHANGE_SET_KWARGS'))
+
+        except ClientError as ex:
+            if self._is_validation_error(ex, 'template'):
+                raise TemplateValidationError(error=ex)
+            raise ex
+
+        finally:
+            self._invalidate_stack_cache()
+
+    @staticmethod
+    def _is_stack_already_exists(ex):
+        """
+        Checks if CREATE Change Set failed because the Stack exists.
+        AlreadyExistsException means Change Set name is taken, not this.
+        :param ex: ClientError raised by create_change_set.
+        :return: True if Stack already exists. False otherwise.
+        """
+        return Stack._is_validation_error(ex, 'Stack [') and \
+            Stack._is_validation_error(ex, '] already exists')
+
+    def _poll(self, get_status, name):
+        """
+        Polls status with exponential backoff and jitter until it is not
+        in progress anymore.
+        :param get_status: Callable returning status and last response.
+        :param name: Name of the wait operation, used in errors.
+        :return: Terminal status and last response.
+        """
+        delay = self.WAITER_DELAY
+        deadline = time.time() + self.WAITER_TIMEOUT
+        while True:
+            status, response = get_status()
+            if not status.endswith(self.IN_PROGRESS_STATUSES):
+                return status, response
+
+            if time.time() >= deadline:
+                raise WaiterError(name=name,
+                                  reason='Max wait time exceeded',
+                                  last_response=response)
+
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, self.WAITER_MAX_DELAY)
+
+    def _stack_status(self):
+        """
+        Gets current CloudFormation Stack status. Missing Stack is reported
+        as deleted.
+        :return: Stack status and Stack information.
+        """
+        stack = self._describe_stack(refresh=True)
+        if not stack:
+            return 'DELETE_COMPLETE', {}
+        return stack['StackStatus'], stack
+
+    def _change_set_status(self):
+        """
+        Gets current CloudFormation Change Set status.
+        :return: Change Set status and Change Set information.
+        """
+        change_set = self._client.describe_change_set(
+            **self._prepare_kwargs('WAIT_CHANGE_SET_KWARGS'))
+        return change_set['Status'], change_set
 
     def _wait_for_stack(self, waiter):
         """
@@ -147,37 +289,38 @@ class Stack:
         :param waiter: create, update, delete.
         :return:
         """
-        waiter = self._client.get_waiter('stack_{0}_complete'.format(waiter))
-        waiter.config.delay = self.WAITER_DELAY
-        try:
-            waiter.wait(**self._prepare_kwargs('WAIT_KWARGS'))
-        except WaiterError as ex:
-            raise ex
+        name = 'stack_{0}_complete'.format(waiter)
+        status, stack = self._poll(self._stack_status, name)
+        if status != '{0}_COMPLETE'.format(waiter.upper()):
+            raise WaiterError(name=name,
+                              reason='Stack status: {0}'.format(status),
+                              last_response=stack)
 
     def _wait_for_change_set(self):
         """
         Waits for CloudFormation Change Set to be created.
         :return:
         """
-        waiter = self._client.get_waiter('change_set_create_complete')
-        waiter.config.delay = self.WAITER_DELAY
-        try:
-            waiter.wait(**self._prepare_kwargs('WAIT_CHANGE_SET_KWARGS'))
-        except WaiterError as e:
-            resp = e.last_response
-            status = resp['Status']
-            reason = resp['StatusReason']
-            msg = ('No updates are to be performed',
-                   'The submitted information didn\'t contain changes.')
-            if status == 'FAILED' and (msg[0] or msg[1] not in reason):
-                raise EmptyChangeSet(stack_name=self.kwargs['StackName'])
-            raise e
+        name = 'change_set_create_complete'
+        status, change_set = self._poll(self._change_set_status, name)
+        if status == 'CREATE_COMPLETE':
+            return
+
+        reason = change_set.get('StatusReason', '')
+        msg = ('No updates are to be performed',
+               'The submitted information didn\'t contain changes.')
+        if status == 'FAILED' and any(m in reason for m in msg):
+            raise EmptyChangeSet(stack_name=self.kwargs['StackName'])
+        raise WaiterError(name=name,
+                          reason='Change Set status: {0}'.format(status),
+                          last_response=change_set)
 
     def _execute_change_set(self):
         """
         Executes CloudFormation Change Set.
         :return:
         """
+        self._invalidate_stack_cache()
         return self._client.execute_change_set(**self._prepare_kwargs(
             'EXECUTE_CHANGE_SET'))
 
@@ -186,15 +329,8 @@ class Stack:
         Wait for Cloud Formation Change Set to be executed.
         :return:
         """
-        change_set_type = self.kwargs['ChangeSetType']
-
-        if change_set_type == 'CREATE':
-            waiter = self._client.get_waiter('stack_create_complete')
-        elif change_set_type == 'UPDATE':
-            waiter = self._client.get_waiter('stack_update_complete')
-
         try:
-            waiter.wait(**self._prepare_kwargs('DESCRIBE_STACKS'))
+            self._wait_for_stack(self.kwargs['ChangeSetType'].lower())
         except WaiterError as ex:
             raise DeployFailed(stack_name=self.kwargs['StackName'], ex=ex)
 
@@ -206,11 +342,13 @@ class Stack:
         if not self._stack_exists():
             raise StackDoesntExist(stack_name=self.kwargs['StackName'])
         try:
+            self._invalidate_stack_cache()
             self._client.update_stack(**self._prepare_kwargs('UPDATE_KWARGS'))
         except ClientError as ex:
-            if 'No updates are to be performed.' in str(ex):
+            msg = 'No updates are to be performed.'
+            if self._is_validation_error(ex, msg):
                 raise UpdateStackError(stack_name=self.kwargs['StackName'])
-            raise ClientError
+            raise ex
 
     def _create_stack(self):
         """
@@ -219,6 +357,7 @@ class Stack:
         """
         if self._stack_exists():
             raise StackAlreadyExist(stack_name=self.kwargs['StackName'])
+        self._invalidate_stack_cache()
         self._client.create_stack(**self._prepare_kwargs('CREATE_KWARGS'))
 
     def _delete_stack(self):
@@ -228,16 +367,17 @@ class Stack:
         """
         if not self._stack_exists():
             raise StackDoesntExist(stack_name=self.kwargs['StackName'])
+        self._invalidate_stack_cache()
         self._client.delete_stack(**self._prepare_kwargs('DELETE_KWARGS'))
 
     def deploy(self, execute_change_set=True):
         """
         Method creates CloudFormation Stack Change Set and executes Change Set.
-        It validates Template first.
+        Template is validated while creating Change Set.
         :param execute_change_set: If True Change Set will be executed.
         :return:
         """
-        self._validate_template()
+        self._load_template()
         self._create_change_set()
         self._wait_for_change_set()
 
@@ -252,7 +392,7 @@ class Stack:
         Metohd creates CloudFormation Stack.
         :return:
         """
-        self._validate_template()
+        self._validate_and_describe()
 
         print('Creating CF Stack...')
         self._create_stack()
@@ -264,7 +404,7 @@ class Stack:
         Metohd updates CloudFormation Stack.
         :return:
         """
-        self._validate_template()
+        self._validate_and_describe()
 
         print('Updating CF Stack...')
         self._update_stack()
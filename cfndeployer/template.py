@@ -28,6 +28,10 @@ from contextlib import contextmanager
 from cfndeployer.exceptions import ExportException, \
     InvalidTemplateUrlParameterError, InvalidTemplatePathError
 
+# Use libyaml based loader and dumper when PyYAML was built with it
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
 
 def intrinsics_multi_constructor(loader, tag_prefix, node):
     """
@@ -72,7 +76,8 @@ def yaml_dump(dict_to_dump):
     :param dict_to_dump:
     :return:
     """
-    return yaml.safe_dump(dict_to_dump, default_flow_style=False)
+    return yaml.dump(dict_to_dump, Dumper=YamlDumper,
+                     default_flow_style=False)
 
 
 def yaml_parse(yamlstr):
@@ -83,9 +88,8 @@ def yaml_parse(yamlstr):
         # json parser.
         return json.loads(yamlstr)
     except ValueError:
-        yaml.SafeLoader.add_multi_constructor(
-            "!", intrinsics_multi_constructor)
-        return yaml.safe_load(yamlstr)
+        YamlLoader.add_multi_constructor("!", intrinsics_multi_constructor)
+        return yaml.load(yamlstr, Loader=YamlLoader)
 
 
 def is_path_value_valid(path):
@@ -461,15 +465,21 @@ class Template(object):
         if "Resources" not in self.template_dict:
             return self.template_dict
 
+        futures = []
         for resource_id, resource in self.template_dict["Resources"].items():
 
             resource_type = resource.get("Type", None)
             resource_dict = resource.get("Properties", None)
 
             if resource_type in self.resources_to_export:
-                # Export code resources
+                # Export code resources, artifacts are uploaded in parallel
                 exporter = self.resources_to_export[resource_type](
                         self.uploader)
-                exporter.export(resource_id, resource_dict, self.template_dir)
+                futures.append(self.uploader.submit(
+                    exporter.export, resource_id, resource_dict,
+                    self.template_dir))
+
+        for future in futures:
+            future.result()
 
         return self.template_dict
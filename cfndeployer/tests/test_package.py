@@ -0,0 +1,217 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import boto3
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+
+from cfndeployer.package import DedupCache, S3Uploader
+
+
+class DedupCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.directory, 'cache', 'dedup.json')
+        self.artifact = os.path.join(self.directory, 'artifact.zip')
+        with open(self.artifact, 'w') as fp:
+            fp.write('artifact')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_key(self):
+        return DedupCache.make_key(
+            self.artifact, os.stat(self.artifact), 'bucket', 'prefix', None)
+
+    def test_round_trip(self):
+        cache = DedupCache(self.cache_file)
+        key = self.make_key()
+        self.assertIsNone(cache.get(key))
+
+        cache.set(key, self.artifact, 's3://bucket/prefix/checksum')
+        self.assertEqual(cache.get(key), 's3://bucket/prefix/checksum')
+        cache.save()
+
+        cache = DedupCache(self.cache_file)
+        self.assertEqual(cache.get(key), 's3://bucket/prefix/checksum')
+        self.assertEqual(os.listdir(os.path.dirname(self.cache_file)),
+                         ['dedup.json'])
+
+    def test_changed_file_misses(self):
+        cache = DedupCache(self.cache_file)
+        cache.set(self.make_key(), self.artifact, 's3://bucket/checksum')
+
+        with open(self.artifact, 'w') as fp:
+            fp.write('changed artifact')
+        self.assertIsNone(cache.get(self.make_key()))
+
+    def test_save_drops_missing_files(self):
+        cache = DedupCache(self.cache_file)
+        key = self.make_key()
+        cache.set(key, self.artifact, 's3://bucket/checksum')
+        os.remove(self.artifact)
+        cache.save()
+
+        self.assertIsNone(DedupCache(self.cache_file).get(key))
+
+    def test_save_ignores_unwritable_path(self):
+        blocker = os.path.join(self.directory, 'blocker')
+        with open(blocker, 'w') as fp:
+            fp.write('not a directory')
+
+        cache = DedupCache(os.path.join(blocker, 'dedup.json'))
+        cache.set(self.make_key(), self.artifact, 's3://bucket/checksum')
+        cache.save()
+
+    def test_corrupt_cache_file(self):
+        key = self.make_key()
+        os.makedirs(os.path.dirname(self.cache_file))
+        for content in ('[]', '{"key": "url"}', '{"key": {"url": "s3://b"}}',
+                        json.dumps({key: {'path': self.artifact}}),
+                        'not json'):
+            with open(self.cache_file, 'w') as fp:
+                fp.write(content)
+
+            cache = DedupCache(self.cache_file)
+            self.assertIsNone(cache.get(key))
+            cache.set(key, self.artifact, 's3://bucket/checksum')
+            cache.save()
+            self.assertEqual(DedupCache(self.cache_file).get(key),
+                             's3://bucket/checksum')
+
+    def test_disabled_cache(self):
+        cache = DedupCache()
+        key = self.make_key()
+        cache.set(key, self.artifact, 's3://bucket/checksum')
+        self.assertIsNone(cache.get(key))
+        cache.save()
+
+
+class MakePartsTest(unittest.TestCase):
+    MiB = 1024 * 1024
+
+    def make_uploader(self, chunksize):
+        client = boto3.client('s3', region_name='us-east-1',
+                              aws_access_key_id='key',
+                              aws_secret_access_key='secret')
+        return S3Uploader(client, 'bucket', 'us-east-1',
+                          multipart_chunksize=chunksize, cache_file=None)
+
+    def assert_contiguous(self, parts, size):
+        offset = 0
+        for number, (part_number, part_offset, length) in enumerate(parts):
+            self.assertEqual(part_number, number + 1)
+            self.assertEqual(part_offset, offset)
+            offset += length
+        self.assertEqual(offset, size)
+
+    def test_last_part_is_shorter(self):
+        size = 20 * self.MiB + 1
+        parts = self.make_uploader(8 * self.MiB).make_parts(size)
+
+        self.assertEqual([length for _, _, length in parts],
+                         [8 * self.MiB, 8 * self.MiB, 4 * self.MiB + 1])
+        self.assert_contiguous(parts, size)
+
+    def test_exact_multiple(self):
+        size = 16 * self.MiB
+        parts = self.make_uploader(8 * self.MiB).make_parts(size)
+
+        self.assertEqual(len(parts), 2)
+        self.assert_contiguous(parts, size)
+
+    def test_part_size_is_at_least_s3_minimum(self):
+        size = 12 * self.MiB
+        parts = self.make_uploader(self.MiB).make_parts(size)
+
+        self.assertEqual([length for _, _, length in parts],
+                         [5 * self.MiB, 5 * self.MiB, 2 * self.MiB])
+        self.assert_contiguous(parts, size)
+
+    def test_number_of_parts_is_limited(self):
+        size = 10000 * 5 * self.MiB + 1
+        parts = self.make_uploader(5 * self.MiB).make_parts(size)
+
+        self.assertLessEqual(len(parts), 10000)
+        self.assert_contiguous(parts, size)
+
+
+class FakePool(object):
+    """
+    Process pool stand-in which uploads parts in the calling process
+    until failed_part is reached.
+    """
+
+    def __init__(self, failed_part=None):
+        self.failed_part = failed_part
+
+    def imap_unordered(self, function, parts):
+        for _, _, _, _, part_number, _, length in reversed(parts):
+            if part_number == self.failed_part:
+                raise IOError('part {} failed'.format(part_number))
+            yield part_number, 'etag-{}'.format(part_number), length
+
+
+class MultiprocessUploadTest(unittest.TestCase):
+    MiB = 1024 * 1024
+
+    def setUp(self):
+        client = boto3.client('s3', region_name='us-east-1',
+                              aws_access_key_id='key',
+                              aws_secret_access_key='secret')
+        self.uploader = S3Uploader(client, 'bucket', 'us-east-1',
+                                   multipart_chunksize=5 * self.MiB,
+                                   cache_file=None)
+        self.stubber = Stubber(client)
+        self.stubber.add_response(
+            'create_multipart_upload', {'UploadId': 'upload'},
+            {'Bucket': 'bucket', 'Key': 'key'})
+        self.stubber.activate()
+
+    def tearDown(self):
+        self.stubber.deactivate()
+
+    def upload(self, pool):
+        self.uploader._get_process_pool = lambda: pool
+        self.uploader.multiprocess_upload(
+            'file', 'key', {}, 12 * self.MiB)
+
+    def test_parts_are_completed_in_order(self):
+        self.stubber.add_response(
+            'complete_multipart_upload', {},
+            {'Bucket': 'bucket', 'Key': 'key', 'UploadId': 'upload',
+             'MultipartUpload': {'Parts': [
+                 {'PartNumber': 1, 'ETag': 'etag-1'},
+                 {'PartNumber': 2, 'ETag': 'etag-2'},
+                 {'PartNumber': 3, 'ETag': 'etag-3'}]}})
+
+        self.upload(FakePool())
+        self.stubber.assert_no_pending_responses()
+
+    def test_failed_part_aborts_upload(self):
+        self.stubber.add_response(
+            'abort_multipart_upload', {},
+            {'Bucket': 'bucket', 'Key': 'key', 'UploadId': 'upload'})
+
+        with self.assertRaises(IOError):
+            self.upload(FakePool(failed_part=2))
+        self.stubber.assert_no_pending_responses()
+
+    def test_failed_completion_aborts_upload(self):
+        self.stubber.add_client_error(
+            'complete_multipart_upload', service_error_code='InvalidPart')
+        self.stubber.add_response(
+            'abort_multipart_upload', {},
+            {'Bucket': 'bucket', 'Key': 'key', 'UploadId': 'upload'})
+
+        with self.assertRaises(ClientError):
+            self.upload(FakePool())
+        self.stubber.assert_no_pending_responses()
+
+    def test_workers_use_client_credentials(self):
+        self.assertEqual(self.uploader._get_credentials(),
+                         ('key', 'secret', None))
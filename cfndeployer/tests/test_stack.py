@@ -0,0 +1,211 @@
+import os
+import datetime
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from botocore.exceptions import ClientError, WaiterError
+from botocore.stub import Stubber
+
+from cfndeployer import client
+from cfndeployer.exceptions import TemplateValidationError, \
+    EmptyChangeSet, DeployFailed
+from cfndeployer.stack import Stack
+
+
+class StackTestCase(unittest.TestCase):
+    """
+    Creates Stack whose CloudFormation client is stubbed. Every test gets
+    its own client with fake credentials.
+    """
+
+    def setUp(self):
+        patches = [
+            mock.patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'key',
+                                         'AWS_SECRET_ACCESS_KEY': 'secret'}),
+            mock.patch.dict(client._clients, clear=True),
+            mock.patch.dict(client._sessions, clear=True)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.stack = Stack(StackName='stack', TemplateBody='{}',
+                           ChangeSetName='change-set', Region='us-east-1')
+        self.stubber = Stubber(self.stack._client)
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+
+
+class CreateChangeSetTest(StackTestCase):
+
+    def add_error(self, code, message):
+        self.stubber.add_client_error(
+            'create_change_set', service_error_code=code,
+            service_message=message)
+
+    def add_response(self, change_set_type):
+        self.stubber.add_response(
+            'create_change_set', {'Id': 'id'},
+            {'StackName': 'stack', 'TemplateBody': '{}',
+             'ChangeSetName': 'change-set',
+             'ChangeSetType': change_set_type})
+
+    def test_create(self):
+        self.add_response('CREATE')
+
+        self.stack._create_change_set()
+        self.assertEqual(self.stack.kwargs['ChangeSetType'], 'CREATE')
+        self.stubber.assert_no_pending_responses()
+
+    def test_update_existing_stack(self):
+        self.add_error('ValidationError',
+                       'Stack [stack] already exists and cannot be created '
+                       'again with the changeSet [change-set].')
+        self.add_response('UPDATE')
+
+        self.stack._create_change_set()
+        self.assertEqual(self.stack.kwargs['ChangeSetType'], 'UPDATE')
+        self.stubber.assert_no_pending_responses()
+
+    def test_existing_change_set_is_raised(self):
+        self.add_error('AlreadyExistsException',
+                       'ChangeSet [change-set] already exists')
+
+        with self.assertRaises(ClientError) as ctx:
+            self.stack._create_change_set()
+        self.assertEqual(ctx.exception.response['Error']['Code'],
+                         'AlreadyExistsException')
+
+    def test_stack_state_error_is_raised(self):
+        self.add_error('ValidationError',
+                       'Stack:arn:stack is in ROLLBACK_COMPLETE state and '
+                       'can not be updated.')
+
+        with self.assertRaises(ClientError):
+            self.stack._create_change_set()
+
+    def test_template_error(self):
+        self.add_error('ValidationError',
+                       'Template format error: JSON not well-formed.')
+
+        with self.assertRaises(TemplateValidationError):
+            self.stack._create_change_set()
+
+
+class ValidateAndDescribeTest(StackTestCase):
+
+    def test_template_file_is_loaded_once(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                         delete=False) as fp:
+            fp.write('{"Resources": {}}')
+        self.addCleanup(os.remove, fp.name)
+        self.stack.kwargs['TemplateBody'] = fp.name
+
+        self.stubber.add_response(
+            'validate_template', {},
+            {'TemplateBody': '{"Resources": {}}'})
+
+        # Describe runs in another thread, so it isn't stubbed in order
+        with mock.patch.object(self.stack, '_describe_stack') as describe, \
+                mock.patch.object(self.stack, '_set_kwarg',
+                                  wraps=self.stack._set_kwarg) as set_kwarg:
+            self.stack._validate_and_describe()
+        set_kwarg.assert_called_once_with('TemplateBody',
+                                          '{"Resources": {}}')
+        describe.assert_called_once_with()
+        self.stubber.assert_no_pending_responses()
+
+
+class WaitTest(StackTestCase):
+
+    def setUp(self):
+        super(WaitTest, self).setUp()
+        patch = mock.patch('cfndeployer.stack.time.sleep')
+        self.sleep = patch.start()
+        self.addCleanup(patch.stop)
+
+    def add_stack_status(self, status):
+        self.stubber.add_response(
+            'describe_stacks',
+            {'Stacks': [{'StackName': 'stack', 'StackStatus': status,
+                         'CreationTime': datetime.datetime(2020, 1, 1)}]},
+            {'StackName': 'stack'})
+
+    def add_change_set_status(self, status, reason=''):
+        self.stubber.add_response(
+            'describe_change_set',
+            {'Status': status, 'StatusReason': reason},
+            {'StackName': 'stack', 'ChangeSetName': 'change-set'})
+
+    def test_in_progress_to_complete(self):
+        self.add_stack_status('UPDATE_IN_PROGRESS')
+        self.add_stack_status('UPDATE_COMPLETE_CLEANUP_IN_PROGRESS')
+        self.add_stack_status('UPDATE_COMPLETE')
+
+        self.stack._wait_for_stack('update')
+        self.assertEqual(self.sleep.call_count, 2)
+        self.stubber.assert_no_pending_responses()
+
+    def test_rollback_fails_deploy(self):
+        self.stack._set_kwarg('ChangeSetType', 'CREATE')
+        self.add_stack_status('CREATE_IN_PROGRESS')
+        self.add_stack_status('ROLLBACK_IN_PROGRESS')
+        self.add_stack_status('ROLLBACK_COMPLETE')
+
+        with self.assertRaises(DeployFailed):
+            self.stack._wait_for_execute()
+        self.stubber.assert_no_pending_responses()
+
+    def test_rollback_raises_waiter_error(self):
+        self.add_stack_status('UPDATE_ROLLBACK_COMPLETE')
+
+        with self.assertRaises(WaiterError):
+            self.stack._wait_for_stack('update')
+
+    def test_deleted_stack(self):
+        self.add_stack_status('DELETE_IN_PROGRESS')
+        self.stubber.add_client_error(
+            'describe_stacks', service_error_code='ValidationError',
+            service_message='Stack with id stack does not exist')
+
+        self.stack._wait_for_stack('delete')
+        self.stubber.assert_no_pending_responses()
+
+    def test_change_set_created(self):
+        self.add_change_set_status('CREATE_PENDING')
+        self.add_change_set_status('CREATE_IN_PROGRESS')
+        self.add_change_set_status('CREATE_COMPLETE')
+
+        self.stack._wait_for_change_set()
+        self.stubber.assert_no_pending_responses()
+
+    def test_empty_change_set(self):
+        self.add_change_set_status(
+            'FAILED', 'The submitted information didn\'t contain changes. '
+                      'Submit different information to create a change set.')
+
+        with self.assertRaises(EmptyChangeSet):
+            self.stack._wait_for_change_set()
+
+    def test_failed_change_set(self):
+        self.add_change_set_status('FAILED', 'Template error')
+
+        with self.assertRaises(WaiterError):
+            self.stack._wait_for_change_set()
+
+    @mock.patch('cfndeployer.stack.time.time', side_effect=[0, 30, 61])
+    def test_timeout(self, _):
+        self.stack.WAITER_TIMEOUT = 60
+        self.add_stack_status('CREATE_IN_PROGRESS')
+        self.add_stack_status('CREATE_IN_PROGRESS')
+
+        with self.assertRaises(WaiterError) as ctx:
+            self.stack._wait_for_stack('create')
+        self.assertIn('Max wait time exceeded', str(ctx.exception))
+        self.assertEqual(self.sleep.call_count, 1)
+        self.stubber.assert_no_pending_responses()
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 from setuptools import find_packages, setup
 
-dependencies = ['botocore', 'boto3', 'PyYAML']
+dependencies = ['botocore', 'boto3', 'PyYAML',
+                'futures; python_version < "3"']
 
 setup(
     name='cfndeployer',